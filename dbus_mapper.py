@@ -1,14 +1,46 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import asyncio
-import copy
 import json
 import logging
 import os
-from datetime import datetime
+import signal
+import socket
+import threading
+import time
 
 import paho.mqtt.client as mqtt
 
+try:
+    import orjson
+
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+    _parse_message = orjson.loads
+except ImportError:
+    try:
+        import ujson
+
+        # ujson escapes forward slashes by default, keep the dbus paths as is like orjson does
+        def _dumps(obj):
+            return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
+
+        _loads = ujson.loads
+    except ImportError:
+        # Fall back to the (slower) stdlib json, producing the same compact bytes as orjson
+        def _dumps(obj):
+            return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+        _loads = json.loads
+    try:
+        import simdjson
+
+        # simdjson only converts the values that are looked up. The parser is reused, a parsed
+        # message stays valid until the next message is parsed.
+        _parse_message = simdjson.Parser().parse
+    except ImportError:
+        _parse_message = _loads
+
 __author__ = ["Marcel Verpaalen"]
 __version__ = "1.1"
 __copyright__ = "Copyright 2023, Marcel Verpaalen"
@@ -31,7 +63,113 @@ MQTT_TOPIC = "/energy/meter"
 LOG_LEVEL = "DEBUG"
 WILL_TOPIC = "/energy/status_dbus_mapper"
 VICTRON_TOPIC = "/dbus-mqtt-services"
+STATUS_ONLINE = "Dbus mapper online"
+STATUS_OFFLINE = b"Dbus mapper offline"
 DEBUG_LOG_MAPPING = False
+MAX_SUPPRESS_SECONDS = 5  # Identical messages are skipped, but republished at least this often
+STATUS_INTERVAL = 30  # Seconds between the online status publishes
+
+
+def record_fragments(path, value_type, extra=None):
+    """
+    Serialize a dbus record without its value.
+
+    Returns the JSON bytes before and after the value, the value itself is serialized when a message is mapped.
+    """
+    head = _dumps({"path": path})[:-1] + b',"value":'
+    tail = b"," + _dumps({"valueType": value_type, "writeable": False, **(extra or {})})[1:]
+    return head, tail
+
+
+class AsyncioHelper:
+    """
+    Drives a paho MQTT client from an asyncio event loop instead of a paho network thread.
+
+    Based on the asyncio example of paho-mqtt, the socket is watched by the event loop and the keepalive
+    handling runs as a task. As there is no paho loop thread, reconnecting after a lost connection is done here.
+    """
+
+    RECONNECT_DELAY_MAX = 120
+
+    def __init__(self, loop, client, name):
+        self.logger = logging.getLogger(__name__)
+        self.loop = loop
+        self.client = client
+        self.name = name
+        self.reconnect_delay = 1
+        self.next_reconnect = 0
+        self.misc = None
+        self.loop_thread = threading.get_ident()
+        self.closed = asyncio.Event()
+        self.closed.set()
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def start(self):
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def stop(self):
+        # Stop the keepalive handling, otherwise the closed connection gets reconnected
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    def call_in_loop(self, callback, *args):
+        # reconnect() runs paho's blocking connect in an executor thread, the socket callbacks it triggers
+        # have to hop back to the event loop
+        if threading.get_ident() == self.loop_thread:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        # Every update is a single small packet, send it right away instead of waiting for Nagle to coalesce writes
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as err:
+            self.logger.debug("%s MQTT socket does not support TCP_NODELAY: %s", self.name, err)
+        self.call_in_loop(self.add_reader, sock)
+
+    def add_reader(self, sock):
+        self.loop.add_reader(sock, self.client.loop_read)
+        self.closed.clear()
+
+    def on_socket_close(self, client, userdata, sock):
+        # paho closes the socket right after this callback, a deferred call needs the file descriptor instead
+        self.call_in_loop(self.remove_reader, sock.fileno())
+
+    def remove_reader(self, fd):
+        self.loop.remove_reader(fd)
+        self.closed.set()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.remove_writer, sock.fileno())
+
+    async def misc_loop(self):
+        while True:
+            if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN and self.loop.time() >= self.next_reconnect:
+                await self.reconnect()
+            await asyncio.sleep(1)
+
+    async def reconnect(self):
+        # A broker can accept the socket and still refuse the CONNECT, so the delay keeps growing until
+        # connection_accepted() is called from on_connect
+        delay = self.reconnect_delay
+        self.next_reconnect = self.loop.time() + delay
+        self.reconnect_delay = min(delay * 2, self.RECONNECT_DELAY_MAX)
+        try:
+            # Connecting blocks up to paho's connect timeout, an unreachable broker must not stall the other client
+            await self.loop.run_in_executor(None, self.client.reconnect)
+        except OSError as err:
+            self.logger.warning("%s MQTT broker connection failed: %s. Retry in %s seconds", self.name, err, delay)
+
+    def connection_accepted(self):
+        self.reconnect_delay = 1
 
 
 class P1Mapper:
@@ -43,55 +181,123 @@ class P1Mapper:
 
     """
 
+    DRAIN_PASSES_MAX = 16
+
     connected = 0
     victron_connected = False
-    message_waiting = False
+    first_message = True
+    _last_ts_sec = 0
+    _last_ts_str = ""
+    _last_payload_hash = None
+    _last_published_hash = None
+    _last_publish_time = 0.0
 
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self.logger.info("Starting Victron DBUS MQTT message mapper")
-        self.logger.info(f"Source MQTT broker {VICTRON_BROKER}")
-        self.logger.info(f"Vicron MQTT broker {SOURCE_MQTT_BROKER}")
+        self.logger.info("Source MQTT broker %s", SOURCE_MQTT_BROKER)
+        self.logger.info("Victron MQTT broker %s", VICTRON_BROKER)
 
         self.loop = asyncio.new_event_loop()
-        dataload = json.load(open(os.path.join(os.path.dirname(__file__), "mapper.json"), encoding="utf-8"))
+        # Before Python 3.10 asyncio primitives bind to the current loop when they are created
+        asyncio.set_event_loop(self.loop)
+        with open(os.path.join(os.path.dirname(__file__), "mapper.json"), "rb") as mapper_file:
+            dataload = _loads(mapper_file.read())
         self.device = dataload["device"]
         self.mapping: list = dataload["dbus_fields"]
+        self._plan = self._compile_mapping()
+        self._debug_mapping = DEBUG_LOG_MAPPING
+        # The device header and its dbus_data records never change, serialize them once so that
+        # only the mapped records need to be serialized and spliced in for every message
+        self._device_header = {key: value for key, value in self.device.items() if key != "dbus_data"}
+        static_data = _dumps(self.device["dbus_data"])[1:-1]
+        response = self._device_header.copy()
+        response["dbus_data"] = []
+        # Device keys up to and including the opening bracket of dbus_data, shared by all payloads
+        self._device_prefix = _dumps(response)[:-2]
+        self._response_prefix = self._device_prefix
+        if static_data:
+            self._response_prefix += static_data + b","
+        # Every message ends with the /Connected and /UpdateIndex records. Both only have a few possible
+        # values, so all variants are serialized upfront and indexed by the connected state and update index.
+        head, tail = record_fragments("/Connected", "integer")
+        self._connected_records = tuple(head + _dumps(value) + tail + b"," for value in (0, 1))
+        head, tail = record_fragments("/UpdateIndex", "integer")
+        self._update_index_records = tuple(head + _dumps(value) + tail + b"]}" for value in range(256))
         self.setup_mqtt_victron()
         self.setup_mqtt_p1()
         self.index = 0
-        self.mqtt_client_victron.loop_start()
-        self.mqtt_client_p1.loop_start()
-        #        self.mqtt_client_p1.loop_forever()
+        # Only the newest message is kept, mapping runs in its own task so socket reads are not held up
+        self.latest_payload = None
+        self.latest_received = 0.0
+        self.message_event = asyncio.Event()
+        self.consumer_task = self.loop.create_task(self.consumer())
+        self.status_task = self.loop.create_task(self.status_loop())
+        self.mqtt_helper_victron.start()
+        self.mqtt_helper_p1.start()
+        # The loop sleeps until there is network activity or a signal, stopping it starts the shutdown
+        self.loop.add_signal_handler(signal.SIGINT, self.loop.stop)
+        self.loop.add_signal_handler(signal.SIGTERM, self.loop.stop)
         try:
             self.loop.run_forever()
+            self.loop.run_until_complete(self.shutdown())
         finally:
             self.loop.close()
 
+    def _compile_mapping(self):
+        # The mapping is static, serialize each dbus record around its value once instead of for every message
+        plan = []
+        for f in self.mapping:
+            if "path" in f and "name" in f:
+                extra = {key: f[key] for key in ("unit", "digits") if key in f}
+                head, tail = record_fragments(f["path"], f["valueType"], extra)
+                plan.append((f["name"], f.get("multiplier"), head, tail + b","))
+        return tuple(plan)
+
+    async def shutdown(self):
+        self.logger.info("Stopping Victron DBUS MQTT message mapper")
+        self.consumer_task.cancel()
+        self.status_task.cancel()
+        self.mqtt_helper_p1.stop()
+        self.mqtt_helper_victron.stop()
+        # A clean disconnect does not trigger the will messages, publish the offline status explicitly
+        self.mqtt_client_p1.publish(WILL_TOPIC, STATUS_OFFLINE, retain=True)
+        # Unlike the static will, this one carries the next update index so the dbus service picks up the change
+        offline = self._device_prefix + self._connected_records[0] + self._update_index_records[self.index & 0xFF]
+        self.mqtt_client_victron.publish(VICTRON_TOPIC, offline, retain=True)
+        self.mqtt_client_p1.disconnect()
+        self.mqtt_client_victron.disconnect()
+        # paho closes the sockets once the pending packets and the DISCONNECT are written
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(self.mqtt_helper_p1.closed.wait(), self.mqtt_helper_victron.closed.wait()), timeout=5
+            )
+        except asyncio.TimeoutError:
+            self.logger.warning("Timeout while disconnecting from the MQTT brokers")
+
     def setup_mqtt_p1(self):
-        self.logger.info(f"Setting up MQTT broker connection to {SOURCE_MQTT_BROKER}")
+        self.logger.info("Setting up MQTT broker connection to %s", SOURCE_MQTT_BROKER)
         self.mqtt_client_p1 = mqtt.Client(userdata=None)
         self.mqtt_client_p1.on_connect = self.on_connect
+        # paho dispatches the meter topic straight to its handler, on_message only sees other topics
+        self.mqtt_client_p1.message_callback_add(MQTT_TOPIC, self.on_meter_message)
         self.mqtt_client_p1.on_message = self.on_message
         self.mqtt_client_p1.on_disconnect = self.on_disconnect
-        self.mqtt_client_p1.will_set(WILL_TOPIC, "Dbus mapper offline", retain=True)
+        self.mqtt_client_p1.on_subscribe = self.on_subscribe
+        self.mqtt_helper_p1 = AsyncioHelper(self.loop, self.mqtt_client_p1, "Source")
+        self.mqtt_client_p1.will_set(WILL_TOPIC, STATUS_OFFLINE, retain=True)
         self.mqtt_client_p1.connect(SOURCE_MQTT_BROKER, 1883, 60)
 
     def setup_mqtt_victron(self):
-        self.logger.info(f"Setting up MQTT broker connection to {VICTRON_BROKER}")
-        self.mqtt_client_victron = mqtt.Client(userdata=None)
+        self.logger.info("Setting up MQTT broker connection to %s", VICTRON_BROKER)
+        # No broker side session is needed, the latest reading is republished after a reconnect anyway
+        self.mqtt_client_victron = mqtt.Client(clean_session=True, userdata=None)
         self.mqtt_client_victron.on_connect = self.on_connect_victron
         self.mqtt_client_victron.on_disconnect = self.on_disconnect_victron
-        will = copy.deepcopy(self.device)
-        will["dbus_data"] = [
-            {
-                "path": "/Connected",
-                "value": 0,
-                "valueType": "integer",
-                "writeable": False,
-            }
-        ]
-        self.mqtt_client_victron.will_set(VICTRON_TOPIC, json.dumps(will), retain=True)
+        self.mqtt_helper_victron = AsyncioHelper(self.loop, self.mqtt_client_victron, "Victron")
+        # Sent by the broker when the connection is lost, marking the device disconnected
+        self._offline_json = self._device_prefix + self._connected_records[0][:-1] + b"]}"
+        self.mqtt_client_victron.will_set(VICTRON_TOPIC, self._offline_json, retain=True)
         self.mqtt_client_victron.connect_async(
             VICTRON_BROKER,
             1883,
@@ -101,140 +307,176 @@ class P1Mapper:
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             self.logger.info("Source broker Connection Established")
+            self.mqtt_helper_p1.connection_accepted()
             self.connected = 1
         else:
             self.logger.warning(
-                f"Source MQTT broker bad connection Returned code={rc}: {rc_desciptions[rc] if rc in rc_desciptions else 'Unknown'}"
+                "Source MQTT broker bad connection Returned code=%s: %s", rc, rc_desc(_CONNACK_RC, rc)
             )
             self.connected = 0
-        client.subscribe(MQTT_TOPIC)
+        client.subscribe(MQTT_TOPIC, qos=0)
         client.publish(
             WILL_TOPIC,
-            f"Dbus mapper online {str(datetime.now().strftime('%d/%m/%Y %H:%M:%S'))}",
+            f"{STATUS_ONLINE} {self.now_str()}".encode(),
             retain=True,
         )
-        self.message_waiting = False
+
+    def on_subscribe(self, client, userdata, mid, granted_qos):
+        for qos in granted_qos:
+            if qos not in (0, 1, 2):
+                self.logger.warning("Subscription to %s refused: %s", MQTT_TOPIC, rc_desc(_SUBACK_RC, qos))
 
     def on_connect_victron(self, client, userdata, flags, rc):
         if rc == 0:
             self.logger.info("Victron MQTT broker Connection Established")
+            self.mqtt_helper_victron.connection_accepted()
             self.victron_connected = True
+            # The broker published the retained will while we were away, the next reading must not be skipped
+            self._last_payload_hash = None
+            self._last_published_hash = None
         else:
             self.logger.warning(
-                f"Victron MQTT broker bad connection Returned code={rc}: {rc_desciptions[rc] if rc in rc_desciptions else 'Unknown'}"
+                "Victron MQTT broker bad connection Returned code=%s: %s", rc, rc_desc(_CONNACK_RC, rc)
             )
 
     def on_disconnect(self, client, userdata, rc):
         if rc != 0:
             self.logger.warning("Unexpected source MQTT disconnection. Will auto-reconnect")
-            self.logger.warning(
-                f"Disconnection code {rc}: {rc_desciptions[rc] if rc in rc_desciptions else 'Unknown'}"
-            )
+            self.logger.warning("Disconnection code %s: %s", rc, rc_desc(_DISCONNECT_RC, rc))
             self.connected = 0
-            self.message_waiting = False
 
     def on_disconnect_victron(self, client, userdata, rc):
         self.victron_connected = False
         if rc != 0:
             self.logger.warning("Unexpected Victron MQTT disconnection. Will auto-reconnect")
-            self.logger.warning(
-                f"Disconnection code {rc}: {rc_desciptions[rc] if rc in rc_desciptions else 'Unknown'}"
-            )
+            self.logger.warning("Disconnection code %s: %s", rc, rc_desc(_DISCONNECT_RC, rc))
 
     def on_message(self, client, userdata, message):
-        self.logger.debug(f"Message topic: {message.topic}")
-        self.logger.debug(f"Message content: {message.payload.decode('utf-8')}")
-        if message.topic == MQTT_TOPIC:
-            self.logger.debug("Message received")
-            if self.victron_connected and not self.message_waiting:
-                self.message_waiting = True
-                #                self.mapper(message.payload.decode("utf-8"))
-                self.loop.call_soon(self.mapper(message.payload.decode("utf-8")), self.loop)
-                self.message_waiting = False
-            else:
-                self.logger.warning(
-                    f"Message skipped, {'previous message pending' if self.victron_connected else 'not connected'}."
-                )
-
-    def mapper(self, message):
-        dbus_data = []
-        meter = json.loads(message)
-        response = copy.deepcopy(self.device)
-        for field in self.mapping:
-            if "path" in field and field["name"] in meter:
-                key = field["name"]
-                if DEBUG_LOG_MAPPING:
-                    self.logger.debug(f"Field {field['name']} found in message {key}")
-                value = meter[key]
-                if "multiplier" in field:
-                    value = value * field["multiplier"]
-                dbus_record = {
-                    "path": field["path"],
-                    "value": value,
-                    "valueType": field["valueType"],
-                    "writeable": False,
-                }
-                if "unit" in field:
-                    dbus_record["unit"] = field["unit"]
-                if "digits" in field:
-                    dbus_record["digits"] = field["digits"]
-                dbus_data.append(dbus_record)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Message on unexpected topic %s ignored", message.topic)
 
-        # Add connected depending on the source mqqt connection and update index to ensure that the dbus service is updated
-        dbus_data.append(
-            {
-                "path": "/Connected",
-                "value": self.connected,
-                "valueType": "integer",
-                "writeable": False,
-            }
-        )
-        dbus_data.append(
-            {
-                "path": "/UpdateIndex",
-                "value": self.index % 256,
-                "valueType": "integer",
-                "writeable": False,
-            }
-        )
-        response["dbus_data"].extend(dbus_data)
-        response_str = json.dumps(response, indent=4)
-        if self.index % 256 == 0:
-            self.logger.info(f"Published message # {self.index}")
-            self.mqtt_client_p1.publish(
-                WILL_TOPIC,
-                f"Dbus mapper online {str(datetime.now().strftime('%d/%m/%Y %H:%M:%S'))}. Published message # {self.index}",
-                retain=True,
+    def on_meter_message(self, client, userdata, message):
+        # Keep the payload as bytes for the json parser
+        payload = message.payload
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Message received on topic: %s", message.topic)
+            self.logger.debug("Message content: %s", payload.decode("utf-8", errors="replace"))
+        if not self.victron_connected:
+            self.logger.warning("Message skipped, not connected.")
+            return
+        # Meters often repeat the same reading, skip the mapping and publish when nothing changed. This shares
+        # the suppression window of mapper(), both measure it from the arrival of the last published message.
+        payload_hash = hash(payload)
+        now = time.monotonic()
+        if payload_hash == self._last_payload_hash and now - self._last_publish_time < MAX_SUPPRESS_SECONDS:
+            self.logger.debug("Message unchanged, skipped")
+            return
+        self._last_payload_hash = payload_hash
+        self.enqueue(payload, now)
+
+    def enqueue(self, payload, received):
+        # Telemetry only needs the newest reading, a burst of messages collapses into a single publish
+        if self.latest_payload is not None:
+            self.logger.debug("Pending message replaced by a newer message")
+        self.latest_payload = payload
+        self.latest_received = received
+        self.message_event.set()
+
+    async def consumer(self):
+        while True:
+            await self.message_event.wait()
+            # paho reads a single packet per reader callback, keep yielding to the socket readers until a loop
+            # pass brings no newer message, so a burst of queued messages ends up as one publish. The passes are
+            # capped, a steady stream of messages must not hold off the mapping forever.
+            for _ in range(self.DRAIN_PASSES_MAX):
+                pending = self.latest_payload
+                await asyncio.sleep(0)
+                if self.latest_payload is pending:
+                    break
+            self.message_event.clear()
+            payload, self.latest_payload = self.latest_payload, None
+            try:
+                self.mapper(payload, self.latest_received)
+            except Exception as err:
+                # A stream of malformed messages should not format a traceback for every one of them
+                self.logger.error("Error mapping message: %s", err, exc_info=self.logger.isEnabledFor(logging.DEBUG))
+
+    async def status_loop(self):
+        # The online status is refreshed on a timer, publishing it never delays a mapped message
+        while True:
+            await asyncio.sleep(STATUS_INTERVAL)
+            status = f"{STATUS_ONLINE} {self.now_str()}"
+            if self.index:
+                status = f"{status}. Published message # {self.index - 1}"
+            self.mqtt_client_p1.publish(WILL_TOPIC, status.encode(), retain=True)
+
+    def now_str(self):
+        # Status messages have a resolution of one second, only format the time again when the second changed
+        now = int(time.time())
+        if now != self._last_ts_sec:
+            self._last_ts_sec = now
+            self._last_ts_str = time.strftime("%d/%m/%Y %H:%M:%S", time.localtime(now))
+        return self._last_ts_str
+
+    def mapper(self, message, received):
+        index = self.index
+        idx_low = index & 0xFF
+        meter = _parse_message(message)
+        # The payload is assembled from the pre-serialized fragments, only the values are serialized here
+        parts = [self._response_prefix]
+        for name, multiplier, head, tail in self._plan:
+            value = meter.get(name)
+            if value is None:
+                continue
+            if multiplier is not None:
+                value = value * multiplier
+            parts.append(head)
+            parts.append(_dumps(value))
+            parts.append(tail)
+        if self._debug_mapping:
+            self.logger.debug(
+                "Fields found in message: %s", [field[0] for field in self._plan if meter.get(field[0]) is not None]
             )
-        if self.index == 0:  # Always print the first message
-            self.logger.info(f"Published message: {response_str}")
-            self.mqtt_client_p1.publish(
-                WILL_TOPIC,
-                f"Dbus mapper online {str(datetime.now().strftime('%d/%m/%Y %H:%M:%S'))}. Published message # {self.index}",
-                retain=True,
+        if len(parts) == 1:
+            self.logger.debug("No mapped fields in message, skipping publish")
+            return
+
+        # Meters send fields that are not mapped (e.g. timestamps), skip the publish when the mapped values did
+        # not change. The update index is left out as it changes with every publish.
+        connected = self.connected
+        published_hash = hash((connected, *parts))
+        if published_hash == self._last_published_hash and received - self._last_publish_time < MAX_SUPPRESS_SECONDS:
+            self.logger.debug("Mapped values unchanged, skipping publish")
+            return
+
+        # Add connected depending on the source mqqt connection and update index to ensure that the dbus service is updated
+        parts.append(self._connected_records[connected])
+        parts.append(self._update_index_records[idx_low])
+        payload = b"".join(parts)
+        if idx_low == 0:
+            self.logger.info("Published message # %s", index)
+        if self.first_message:  # Always print the first message
+            self.first_message = False
+            # Log the payload as published instead of parsing and serializing it again to pretty print it
+            if self.logger.isEnabledFor(logging.INFO):
+                self.logger.info("Published message: %s", payload.decode())
+        elif self._debug_mapping and self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Published message: %s", payload.decode())
+        # Telemetry is superseded by the next reading, QoS 0 keeps paho from tracking it until acknowledged
+        result = self.mqtt_client_victron.publish(VICTRON_TOPIC, payload, qos=0)
+        if result.rc:
+            self.logger.warning(
+                "Error message # %s during publish: %s", index, rc_desc(_PUBLISH_RC, result.rc)
             )
         else:
-            if DEBUG_LOG_MAPPING:
-                self.logger.debug(f"Published message: {response_str}")
-        rc = self.mqtt_client_victron.publish(VICTRON_TOPIC, response_str)
-        if rc[0] != 0:
-            self.logger.warning(f"Error message # {self.index} during publish: {rc}")
-        else:
-            self.logger.debug(f"success message # {self.index}")
-        self.index += 1
-
-
-rc_desciptions = {
-    0: "Success",
-    0: "Normal disconnection",
-    0: "Granted QoS 0",
-    1: "Granted QoS 1",
-    2: "Granted QoS 2",
-    4: "Disconnect with Will Message",
-    16: "No matching subscribers",
-    17: "No subscription existed",
-    24: "Continue authentication",
-    25: "Re-authenticate",
+            self.logger.debug("success message # %s", index)
+            self._last_published_hash = published_hash
+            self._last_publish_time = received
+        self.index = index + 1
+
+
+# MQTT v5 reason codes, shared by the CONNACK and DISCONNECT packets
+_REASON_CODES = {
     128: "Unspecified error",
     129: "Malformed Packet",
     130: "Protocol Error",
@@ -273,5 +515,79 @@ rc_desciptions = {
 }
 
 
+def _rc_table(codes):
+    # Return codes are small ints below 128 or MQTT v5 reason codes from 128 up, index a short tuple for
+    # each range instead of hashing into a dict or keeping one tuple padded with the gap in between
+    low = tuple(codes.get(rc) for rc in range(max((rc for rc in codes if rc < 128), default=-1) + 1))
+    high = tuple(codes.get(rc) for rc in range(128, max(codes) + 1))
+    return low, high
+
+
+def rc_desc(table, rc):
+    low, high = table
+    if 0 <= rc < len(low):
+        return low[rc] or "Unknown"
+    if 0 <= rc - 128 < len(high):
+        return high[rc - 128] or "Unknown"
+    return "Unknown"
+
+
+# Return codes passed to on_connect (MQTT v3.1.1 CONNACK)
+_CONNACK_RC = _rc_table(
+    {
+        0: "Connection accepted",
+        1: "Incorrect protocol version",
+        2: "Invalid client identifier",
+        3: "Server unavailable",
+        4: "Bad user name or password",
+        5: "Not authorized",
+        **_REASON_CODES,
+    }
+)
+
+# Return codes per topic passed to on_subscribe (MQTT v3.1.1 SUBACK)
+_SUBACK_RC = _rc_table(
+    {
+        0: "Granted QoS 0",
+        1: "Granted QoS 1",
+        2: "Granted QoS 2",
+        128: "Failure",
+    }
+)
+
+# Return codes passed to on_disconnect (paho client error codes)
+_DISCONNECT_RC = _rc_table(
+    {
+        mqtt.MQTT_ERR_SUCCESS: "Normal disconnection",
+        mqtt.MQTT_ERR_NOMEM: "Out of memory",
+        mqtt.MQTT_ERR_PROTOCOL: "Protocol error",
+        mqtt.MQTT_ERR_INVAL: "Invalid function arguments",
+        mqtt.MQTT_ERR_NO_CONN: "The client is not currently connected",
+        mqtt.MQTT_ERR_CONN_REFUSED: "The connection was refused",
+        mqtt.MQTT_ERR_NOT_FOUND: "Message not found",
+        mqtt.MQTT_ERR_CONN_LOST: "The connection was lost",
+        mqtt.MQTT_ERR_TLS: "A TLS error occurred",
+        mqtt.MQTT_ERR_PAYLOAD_SIZE: "Payload too large",
+        mqtt.MQTT_ERR_NOT_SUPPORTED: "This feature is not supported",
+        mqtt.MQTT_ERR_AUTH: "Authorisation failed",
+        mqtt.MQTT_ERR_ACL_DENIED: "Access denied by ACL",
+        mqtt.MQTT_ERR_UNKNOWN: "Unknown error",
+        mqtt.MQTT_ERR_ERRNO: "Error defined by errno",
+        mqtt.MQTT_ERR_QUEUE_SIZE: "Message queue full",
+        mqtt.MQTT_ERR_KEEPALIVE: "Client or broker did not communicate in the keepalive interval",
+        **_REASON_CODES,
+    }
+)
+
+# Return codes of publish() (paho client error codes)
+_PUBLISH_RC = _rc_table(
+    {
+        mqtt.MQTT_ERR_SUCCESS: "Success",
+        mqtt.MQTT_ERR_NO_CONN: "The client is not currently connected",
+        mqtt.MQTT_ERR_QUEUE_SIZE: "Message queue full",
+    }
+)
+
+
 if __name__ == "__main__":
     P1_mapper = P1Mapper()